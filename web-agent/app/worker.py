@@ -1,27 +1,42 @@
 #!/usr/bin/env python3
 import argparse
+import atexit
 import base64
 import json
 import os
+import queue
+import random
 import secrets
-import string
+import socket
 import uuid
 from collections import deque
-from logging.handlers import TimedRotatingFileHandler
-from pathlib import Path
-from typing import Optional, Tuple, Any, Dict
+from http.cookiejar import DefaultCookiePolicy
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+from types import MappingProxyType
+from typing import Optional, Tuple, Any, Dict, BinaryIO, Mapping, Union
 
 import requests
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.connection import HTTPConnection
+from urllib3.util.retry import Retry
 import logging
 import time
 import gzip
+import io
 from urllib.parse import unquote
 import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson  # optional, faster json (de)serialization
+except ImportError:
+    orjson = None
 
 # Global variables
 __version__ = "1.1.2"
-letters: str = string.ascii_letters
-rand_string: str = ''.join(secrets.choice(letters) for _ in range(10))
+rand_string: str = secrets.token_urlsafe(8)[:10]
 
 ac_str = 'armorcode'
 
@@ -30,14 +45,25 @@ log_folder: str = os.path.join(armorcode_folder, 'log')
 output_file_folder: str = os.path.join(armorcode_folder, 'output_files')
 
 max_file_size: int = 1024 * 500  # max_size data that would be sent in payload, more than that will send via s3
+max_log_size: int = 1024  # request and response bodies are truncated to this size in the logs
 logger: Optional[logging.Logger] = None
 api_key: Optional[str] = None
 server_url: Optional[str] = None
 
+# armorcode endpoints, built once from server_url at startup
+get_task_url: Optional[str] = None
+put_result_url: Optional[str] = None
+upload_result_url: Optional[str] = None
+upload_url_url: Optional[str] = None
+# read-only headers for armorcode, built once api_key is known
+ac_auth_headers: Optional[Mapping[str, str]] = None
+ac_headers: Optional[Mapping[str, str]] = None
+
 verify_cert: bool = True
 max_retry: int = 3
 max_backoff_time: int = 600
 min_backoff_time: int = 5
+max_idle_backoff_time: int = 20  # cap for the wait between polls while no task is available
 
 timeout: int = 10
 
@@ -49,9 +75,21 @@ rate_limiter = None
 
 upload_to_ac = False
 
+# kept alive across tasks to reuse connections, ac_session for armorcode, s3_session for s3 uploads,
+# inward_session for internal tools
+ac_session: Optional[requests.Session] = None
+s3_session: Optional[requests.Session] = None
+inward_session: Optional[requests.Session] = None
+
+# tasks run on thread_pool, task_slots limits how many are fetched ahead of a free worker
+thread_pool: Optional[ThreadPoolExecutor] = None
+task_slots: Optional[threading.BoundedSemaphore] = None
+
 
 def main() -> None:
     global api_key, server_url, logger, exponential_time_backoff, verify_cert, timeout, rate_limiter, inward_proxy, outgoing_proxy, upload_to_ac
+    global get_task_url, put_result_url, upload_result_url, upload_url_url, ac_auth_headers, ac_headers, ac_session, s3_session, inward_session
+    global thread_pool, task_slots
 
     parser = argparse.ArgumentParser()
     parser.add_argument("--serverUrl", required=False, help="Server Url")
@@ -68,6 +106,7 @@ def main() -> None:
     parser.add_argument("--outgoingProxyHttp", required=False, help="Pass outgoing Http proxy", default=None)
     parser.add_argument("--uploadToAc", action="store_true", help="Upload to Armorcode instead of s3 (default: False)",
                         default=False)
+    parser.add_argument("--poolSize", required=False, help="Number of tasks processed in parallel", default=5)
 
     args = parser.parse_args()
 
@@ -78,6 +117,7 @@ def main() -> None:
     verify_cmd = args.verify
     debug_cmd = args.debugMode
     upload_to_ac = args.uploadToAc
+    pool_size: int = int(args.poolSize)
 
     inward_proxy_https = args.inwardProxyHttps
     inward_proxy_http = args.inwardProxyHttp
@@ -130,19 +170,35 @@ def main() -> None:
     if api_key is None:
         api_key = os.getenv("api_key")
 
-    logger.info("Agent Started for url %s, verify %s, timeout %s, outgoing proxy %s, inward %s, uploadToAc %s", server_url,
-                verify_cert, timeout, outgoing_proxy, inward_proxy, upload_to_ac)
+    logger.info("Agent Started for url %s, verify %s, timeout %s, outgoing proxy %s, inward %s, uploadToAc %s, "
+                "poolSize %s", server_url, verify_cert, timeout, outgoing_proxy, inward_proxy, upload_to_ac, pool_size)
 
     if server_url is None or api_key is None:
         logger.error("Empty serverUrl %s", server_url)
         raise ValueError("Server URL and API Key must be provided either as arguments or environment variables")
 
+    get_task_url = f"{server_url}/api/http-teleport/get-task"
+    put_result_url = f"{server_url}/api/http-teleport/put-result"
+    upload_result_url = f"{server_url}/api/http-teleport/upload-result"
+    upload_url_url = f"{server_url}/api/http-teleport/upload-url"
+    ac_auth_headers = MappingProxyType({
+        "Authorization": f"Bearer {api_key}",
+    })
+    ac_headers = MappingProxyType({
+        **ac_auth_headers,
+        "Content-Type": "application/json"
+    })
+
     # Creating thread pool to use other thread if one thread is blocked in I/O
-    # pool: concurrent.futures.ThreadPoolExecutor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
-    # pool.submit(process)
-    # pool.submit(process)
-    #
-    # pool.shutdown(wait=True)
+    thread_pool = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="task")
+    task_slots = threading.BoundedSemaphore(pool_size)
+
+    # armorcode requests are not retried on the connection, every attempt has to go through the rate limiter
+    # and the callers' backoff. S3 gateway errors are retried on the connection, urllib3 rewinds the file body
+    ac_session = _create_session()
+    s3_session = _create_session(Retry(total=3, backoff_factor=0.2, status_forcelist=[502, 503, 504],
+                                       raise_on_status=False))
+    inward_session = _create_session()
 
     # Instantiate RateLimiter for 25 requests per 15 seconds window
     rate_limiter = RateLimiter(request_limit=25, time_window=15)
@@ -150,16 +206,22 @@ def main() -> None:
 
 
 def process() -> None:
-    headers: Dict[str, str] = _get_headers()
+    headers: Mapping[str, str] = _get_headers()
     thread_backoff_time: int = min_backoff_time
+    idle_backoff_time: float = min_backoff_time
+    arrival_ewma: float = min_backoff_time  # moving average of the seconds between two received tasks
+    last_task_time: float = time.monotonic()
     while True:
+        # Wait for a free worker before requesting the next task
+        task_slots.acquire()
+        submitted: bool = False
         try:
             # Get the next task for the agent
             logger.info("Requesting task...")
             rate_limiter.throttle()
 
-            get_task_response: requests.Response = requests.get(
-                f"{server_url}/api/http-teleport/get-task",
+            get_task_response: requests.Response = ac_session.get(
+                get_task_url,
                 headers=headers,
                 timeout=25, verify=verify_cert,
                 proxies=outgoing_proxy
@@ -167,23 +229,25 @@ def process() -> None:
 
             if get_task_response.status_code == 200:
                 thread_backoff_time = min_backoff_time
-                task: Optional[Dict[str, Any]] = get_task_response.json().get('data', None)
+                task: Optional[Dict[str, Any]] = _json_loads(get_task_response.content).get('data', None)
                 if task is None:
                     logger.info("Received empty task")
-                    time.sleep(5)  # Wait before requesting next task
+                    idle_backoff_time = _idle_wait(idle_backoff_time)  # Wait before requesting next task
                     continue
 
+                # Poll sooner while tasks keep arriving, the backoff grows again once the queue is empty
+                current_time = time.monotonic()
+                arrival_ewma = 0.7 * arrival_ewma + 0.3 * (current_time - last_task_time)
+                last_task_time = current_time
+                idle_backoff_time = min(max(arrival_ewma * 0.5, 1), max_idle_backoff_time)
                 logger.info("Received task: %s", task['taskId'])
                 task["version"] = __version__
-                # Process the task
-
-                result: Dict[str, Any] = process_task(task)
-
-                # Update the task status
-                update_task(result)
+                # Process the task on the pool, the slot is released once the task is done
+                thread_pool.submit(process_task_async, task)
+                submitted = True
             elif get_task_response.status_code == 204:
                 logger.info("No task available. Waiting...")
-                time.sleep(5)
+                idle_backoff_time = _idle_wait(idle_backoff_time)
             elif get_task_response.status_code > 500:
                 logger.error("Getting 5XX error %d, increasing backoff time", get_task_response.status_code)
                 time.sleep(thread_backoff_time)
@@ -198,48 +262,94 @@ def process() -> None:
         except Exception as e:
             logger.error("Unexpected error while processing: %s", e)
             time.sleep(5)
+        finally:
+            if not submitted:
+                task_slots.release()
 
 
-def update_task(task: Optional[Dict[str, Any]], count: int = 0) -> None:
+def _idle_wait(idle_backoff_time: float) -> float:
+    # full jitter, so that agents polling an empty queue don't stay in lockstep; returns the next backoff
+    time.sleep(random.uniform(0, idle_backoff_time))
+    return min(max_idle_backoff_time, idle_backoff_time * 2)
+
+
+def process_task_async(task: Dict[str, Any]) -> None:
+    try:
+        result: Dict[str, Any] = process_task(task)
+
+        # Update the task status
+        update_task(result)
+    except Exception as e:
+        logger.error("Unexpected error while processing task %s: %s", task['taskId'], e)
+    finally:
+        task_slots.release()
+
+
+def update_task(task: Optional[Dict[str, Any]]) -> None:
     if task is None:
         return
-    # Update the task status
-    if count > max_retry:
-        logger.error("Retry count exceeds for task %s", task['taskId'])
-        return
-    try:
-        rate_limiter.throttle()
-        update_task_response: requests.Response = requests.post(
-            f"{server_url}/api/http-teleport/put-result",
-            headers=_get_headers(),
-            json=task,
-            timeout=30, verify=verify_cert, proxies=outgoing_proxy
-        )
+    # serialized once and reused by the retries
+    body: bytes = _json_dumps(task)
+    headers: Mapping[str, str] = _get_headers()
+    for attempt in range(max_retry + 1):
+        if attempt > 0:
+            # jittered exponential backoff, so that agents don't retry in lockstep
+            time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+        # Update the task status
+        try:
+            rate_limiter.throttle()
+            update_task_response: requests.Response = ac_session.post(
+                put_result_url,
+                headers=headers,
+                data=body,
+                timeout=30, verify=verify_cert, proxies=outgoing_proxy
+            )
 
-        if update_task_response.status_code == 200:
-            logger.info("Task %s updated successfully. Response: %s", task['taskId'],
-                        update_task_response.text)
-        elif update_task_response.status_code == 429 or update_task_response.status_code == 504:
-            time.sleep(2)
-            logger.warning("Rate limit hit while updating the task output, retrying again for task %s", task['taskId'])
-            count = count + 1
-            update_task(task, count)
-        else:
-            logger.warning("Failed to update task %s: %s", task['taskId'], update_task_response.text)
+            if update_task_response.status_code == 200:
+                logger.info("Task %s updated successfully. Response: %s", task['taskId'],
+                            update_task_response.text[:max_log_size])
+                return
+            elif update_task_response.status_code == 429 or update_task_response.status_code == 504:
+                logger.warning("Rate limit hit while updating the task output, retrying again for task %s",
+                               task['taskId'])
+            else:
+                logger.warning("Failed to update task %s: %s", task['taskId'],
+                               update_task_response.text[:max_log_size])
+                return
+        except requests.exceptions.RequestException as e:
+            logger.error("Network error processing task %s: %s", task['taskId'], e)
+    logger.error("Retry count exceeds for task %s", task['taskId'])
 
 
-    except requests.exceptions.RequestException as e:
-        logger.error("Network error processing task %s: %s", task['taskId'], e)
-        count = count + 1
-        update_task(task, count)
+def _get_headers() -> Mapping[str, str]:
+    return ac_headers
 
 
-def _get_headers() -> Dict[str, str]:
-    headers: Dict[str, str] = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-    return headers
+def _create_session(max_retries: Union[Retry, int] = 0) -> requests.Session:
+    session = requests.Session()
+    # cookies set by one task's response must not be sent with the next task
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    adapter = AgentHTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=max_retries)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def _unique_id() -> str:
+    # url-safe, 22 characters instead of the 32 of uuid4().hex
+    return base64.urlsafe_b64encode(uuid.uuid4().bytes).rstrip(b'=').decode('ascii')
+
+
+def _json_dumps(data: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode('utf-8')
+
+
+def _json_loads(data: bytes) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
 
 
 def process_task(task: Dict[str, Any]) -> Dict[str, Any]:
@@ -251,74 +361,62 @@ def process_task(task: Dict[str, Any]) -> Dict[str, Any]:
     expiryTime: int = task.get('expiryTsMs', round((time.time() + 300) * 1000))
     logger.info("Processing task %s: %s %s", taskId, method, url)
 
-    # creating temp file to store outputs
-    temp_output_file = tempfile.NamedTemporaryFile(
-        prefix="output_file" + taskId,
-        suffix=".txt",
-        dir=output_file_folder,
-        delete=False
-    )
-
-    temp_output_file_zip = tempfile.NamedTemporaryFile(
-        prefix="output_file_zip" + taskId,
-        suffix=".zip",
-        dir=output_file_folder,
-        delete=False
-    )
-
+    # temp file is only created once the response grows beyond max_file_size
+    temp_output_file: Optional[str] = None
     try:
         # Running the request
         # timeout = round((expiryTime - round(time.time() * 1000)) / 1000)
         # logger.info("expiry %s, %s", expiryTime, timeout)
 
-        logger.debug("Request for task %s with headers %s and input_data %s", taskId, headers, input_data)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Request for task %s with headers %s and input_data %s", taskId, headers,
+                         str(input_data)[:max_log_size])
         check_and_update_encode_url(headers, url)
-        response: requests.Response = requests.request(method, url, headers=headers, data=input_data, stream=True,
-                                                       timeout=timeout, verify=verify_cert, proxies=inward_proxy)
+        response: requests.Response = inward_session.request(method, url, headers=headers, data=input_data,
+                                                             stream=True, timeout=timeout, verify=verify_cert,
+                                                             proxies=inward_proxy)
         logger.info("Response: %d", response.status_code)
 
-        data: Any = None
-        if response.status_code == 200:
-            # Check if the response is chunked
-            is_chunked: bool = response.headers.get('Transfer-Encoding', None) == 'chunked'
-
-            if is_chunked:
-                logger.info("Processing in chunks...")
-                # Process the response in chunks
-                with open(temp_output_file.name, 'wb') as f:
-                    for chunk in response.iter_content(chunk_size=1024 * 100):
-                        if chunk:
-                            f.write(chunk)
-            else:
-                logger.info("Non-chunked response, processing whole payload...")
-                data = response.content  # Entire response is downloaded
-                with open(temp_output_file.name, 'wb') as f:
-                    f.write(data)
-        else:
-            logger.debug("Status code is not 200 , response is %s", response.content)
-            data = response.content  # Entire response is downloaded if request failed
-            with open(temp_output_file.name, 'wb') as f:
-                f.write(data)
-
         task['responseHeaders'] = dict(response.headers)
         task['statusCode'] = response.status_code
 
-        file_size: int = os.path.getsize(temp_output_file.name)
+        # Keep the response in memory while it is small, spill it to a temp file once it crosses max_file_size
+        data: bytearray = bytearray()
+        chunks = response.iter_content(chunk_size=1024 * 1024)
+        for chunk in chunks:
+            data += chunk
+            if len(data) > max_file_size:
+                break
+        file_size: int = len(data)
+
+        if response.status_code != 200:
+            logger.debug("Status code is not 200 , response is %s", bytes(data[:max_log_size]))
+
+        if file_size > max_file_size:
+            temp_output_file, output_file = open_output_file(taskId)
+            with output_file:
+                preallocated: bool = (not upload_to_ac and 'Content-Encoding' not in response.headers
+                                      and _preallocate(output_file, response.headers.get('Content-Length')))
+                output_file.write(data)
+                data = bytearray()
+                # Continue with the same iterator, the remaining chunks go straight to the file
+                for chunk in chunks:
+                    output_file.write(chunk)
+                file_size = output_file.tell()
+                if preallocated:
+                    # drop any reserved space the body did not fill
+                    output_file.truncate()
         logger.info("file size %s", file_size)
-        is_s3_upload: bool = file_size > max_file_size  # if size is greater than max_size, upload data to s3
 
-        if not is_s3_upload:
+        if temp_output_file is None:
             logger.info("Data is less than %s, sending data in response", max_file_size)
-            with open(temp_output_file.name, 'rb') as file:
-                file_data = file.read()
-                if len(file_data) == 0:
-                    return task
-                base64_string = base64.b64encode(file_data).decode('utf-8')
+            if file_size > 0:
                 task['responseBase64'] = True
-                task['output'] = base64_string
+                task['output'] = base64.b64encode(data).decode('ascii')
             return task
 
-        return upload_response(temp_output_file.name, temp_output_file_zip.name, taskId, task)
+        # if size is greater than max_size, upload data to s3
+        return upload_response(temp_output_file, taskId, task)
     except requests.exceptions.RequestException as e:
         logger.error("Network error processing task %s: %s", taskId, e)
         task['statusCode'] = 500
@@ -327,56 +425,87 @@ def process_task(task: Dict[str, Any]) -> Dict[str, Any]:
         logger.error("Unexpected error processing task %s: %s", taskId, e)
         task['statusCode'] = 500
         task['output'] = f"Error: {str(e)}"
-    os.unlink(temp_output_file.name)
-    os.unlink(temp_output_file_zip.name)
+    finally:
+        if temp_output_file is not None:
+            _delete_file(temp_output_file)
     return task
 
 
-def zip_response(temp_file, temp_file_zip) -> bool:
+def _delete_file(file_path: str) -> None:
     try:
-        if not (Path(temp_file).is_relative_to(tempfile.gettempdir()) and
-                Path(temp_file_zip).is_relative_to(tempfile.gettempdir())):
-            raise ValueError("Files must be within the allowed directory")
-
-        chunk_size = 1024 * 1024
-        with open(temp_file, 'rb') as f_in:
-            with gzip.open(temp_file_zip, 'wb') as f_out:
-                while True:
-                    chunk = f_in.read(chunk_size)
-                    if not chunk:
-                        break
-                    f_out.write(chunk)
+        os.unlink(file_path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.error("Unable to delete file %s: %s", file_path, e)
+
 
+def _preallocate(file: BinaryIO, content_length: Optional[str]) -> bool:
+    # Reserve the full size of the spill file up front instead of growing it on every write
+    if content_length is None or not hasattr(os, 'posix_fallocate'):
+        return False
+    try:
+        size = int(content_length)
+    except ValueError:
+        logger.warning("Invalid Content-Length %s", content_length[:max_log_size])
+        return False
+    if size <= 0:
+        return False
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
         return True
-    except Exception as e:
-        logger.error("Unable to zip file: %s", e)
+    except OSError as e:
+        logger.debug("Unable to preallocate %d bytes: %s", size, e)
         return False
 
 
-def upload_response(temp_file, temp_file_zip, taskId: str, task: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+def _advise_sequential(file: BinaryIO) -> None:
+    # The spill file is read once front to back while uploading, ask for aggressive readahead where supported
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except OSError:
+            pass
+
+
+def open_output_file(taskId: str) -> Tuple[str, BinaryIO]:
+    # Output uploaded to armorcode is zipped while it is written, instead of re-reading the file afterwards
+    temp_output_file = tempfile.NamedTemporaryFile(
+        prefix=("output_file_zip" if upload_to_ac else "output_file") + taskId,
+        suffix=".zip" if upload_to_ac else ".txt",
+        dir=output_file_folder,
+        delete=False
+    )
+    if not upload_to_ac:
+        return temp_output_file.name, temp_output_file
+    temp_output_file.close()
+    return temp_output_file.name, gzip.open(temp_output_file.name, 'wb', compresslevel=1)
+
+
+def upload_response(temp_file, taskId: str, task: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     if upload_to_ac:
         try:
-            success = zip_response(temp_file, temp_file_zip)
-            file_path = temp_file_zip if success else temp_file
-            task['responseZipped'] = success
-            file_name = f"{taskId}_{uuid.uuid4().hex}.{'zip' if success else 'txt'}"
-            headers: Dict[str, str] = {
-                "Authorization": f"Bearer {api_key}",
-            }
-            task_json = json.dumps(task)
-            files = {
-                # 'fileFieldName' is the name of the form field expected by the server
-                "file": (file_name, open(file_path, "rb"), f"{'application/zip' if success else 'text/plain'}"),
-                "task": (None, task_json, "application/json")
-                # If you have multiple files, you can add them here as more entries
-            }
-            rate_limiter.throttle()
-            upload_result: requests.Response = requests.post(
-                f"{server_url}/api/http-teleport/upload-result",
-                headers=headers,
-                timeout=300, verify=verify_cert, proxies=outgoing_proxy, files=files
-            )
-            logger.info("Upload result response: %s, code: %d", upload_result.text, upload_result.status_code)
+            task['responseZipped'] = True
+            file_name = f"{taskId}_{_unique_id()}.zip"
+            task_json: bytes = _json_dumps(task)
+            with open(temp_file, "rb") as file:
+                _advise_sequential(file)
+                # streamed from disk instead of requests reading the whole file into memory
+                multipart = MultipartStream({
+                    # 'fileFieldName' is the name of the form field expected by the server
+                    "file": (file_name, file, "application/zip"),
+                    "task": (None, task_json, "application/json")
+                    # If you have multiple files, you can add them here as more entries
+                })
+                headers: Dict[str, str] = {**ac_auth_headers, "Content-Type": multipart.content_type}
+                rate_limiter.throttle()
+                upload_result: requests.Response = ac_session.post(
+                    upload_result_url,
+                    headers=headers,
+                    timeout=300, verify=verify_cert, proxies=outgoing_proxy, data=multipart
+                )
+            logger.info("Upload result response: %s, code: %d", upload_result.text[:max_log_size],
+                        upload_result.status_code)
             upload_result.raise_for_status()
             return None
         except Exception as e:
@@ -396,34 +525,106 @@ def upload_response(temp_file, temp_file_zip, taskId: str, task: Dict[str, Any])
         return task
 
 
+class AgentHTTPAdapter(HTTPAdapter):
+    # Request bodies (s3 and armorcode uploads) are sent in 1 MiB blocks instead of urllib3's default 16 KiB.
+    # Only urllib3 2.x accepts blocksize as a pool argument
+    connection_kwargs: Dict[str, Any] = {} if urllib3.__version__.startswith("1.") else {"blocksize": 1024 * 1024}
+    # TCP keepalive on top of urllib3's default TCP_NODELAY, so that idle pooled connections dropped by
+    # firewalls or proxies are detected instead of hanging the next request.
+    # The kernel default waits 2 hours before the first probe, probe after 60s idle and give up after 4 x 15s
+    connection_kwargs["socket_options"] = HTTPConnection.default_socket_options + [
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    ] + [
+        (socket.IPPROTO_TCP, getattr(socket, name), value)
+        for name, value in (("TCP_KEEPIDLE", 60), ("TCP_KEEPINTVL", 15), ("TCP_KEEPCNT", 4))
+        if hasattr(socket, name)
+    ]
+
+    def init_poolmanager(self, *args, **pool_kwargs) -> None:
+        super().init_poolmanager(*args, **self.connection_kwargs, **pool_kwargs)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        return super().proxy_manager_for(proxy, **self.connection_kwargs, **proxy_kwargs)
+
+
+class MultipartStream:
+    # multipart/form-data body that is read part by part while it is sent, with a known length
+    def __init__(self, fields: Dict[str, Tuple[Optional[str], Any, str]]) -> None:
+        self.boundary: str = uuid.uuid4().hex
+        self.content_type: str = f"multipart/form-data; boundary={self.boundary}"
+        self.parts: deque = deque()
+        self.length: int = 0
+        for name, (file_name, content, content_type) in fields.items():
+            disposition = f'form-data; name="{name}"'
+            if file_name is not None:
+                disposition += f'; filename="{file_name}"'
+            self._add_bytes(f"--{self.boundary}\r\nContent-Disposition: {disposition}\r\n"
+                            f"Content-Type: {content_type}\r\n\r\n".encode('utf-8'))
+            if isinstance(content, str):
+                self._add_bytes(content.encode('utf-8'))
+            elif isinstance(content, bytes):
+                self._add_bytes(content)
+            else:
+                self.parts.append(content)
+                self.length += os.fstat(content.fileno()).st_size - content.tell()
+            self._add_bytes(b"\r\n")
+        self._add_bytes(f"--{self.boundary}--\r\n".encode('utf-8'))
+
+    def _add_bytes(self, data: bytes) -> None:
+        self.parts.append(io.BytesIO(data))
+        self.length += len(data)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def read(self, size: int = -1) -> bytes:
+        data = bytearray()
+        while self.parts and (size < 0 or len(data) < size):
+            chunk = self.parts[0].read(-1 if size < 0 else size - len(data))
+            if not chunk:
+                self.parts.popleft()
+            data += chunk
+        return bytes(data)
+
+
 def check_and_update_encode_url(headers, url: str):
     if "/cxrestapi/auth/identity/connect/token" in url:
         headers["Content-Type"] = "application/x-www-form-urlencoded"
 
 
 class RateLimiter:
+    # Sliding window: at most request_limit requests in any time_window seconds
     def __init__(self, request_limit: int, time_window: int) -> None:
         self.request_limit = request_limit
         self.time_window = time_window
-        self.timestamps = deque()
+        self.timestamps: deque = deque()
+        self.lock = threading.Lock()  # shared by the poller and the task threads
 
-    def allow_request(self) -> bool:
+    def _take_token(self) -> float:
+        # Returns 0 if the request can be sent, otherwise the seconds until the oldest request leaves the window
+        with self.lock:
+            # monotonic clock, so that system clock changes don't affect the window
+            current_time = time.monotonic()
 
-        current_time = time.time()
+            # Remove timestamps older than the time window
+            while self.timestamps and self.timestamps[0] <= current_time - self.time_window:
+                self.timestamps.popleft()
 
-        # Remove timestamps older than the time window
-        while self.timestamps and self.timestamps[0] < current_time - self.time_window:
-            self.timestamps.popleft()
+            # Check if we can send a new request
+            if len(self.timestamps) < self.request_limit:
+                self.timestamps.append(current_time)
+                return 0
+            return self.timestamps[0] + self.time_window - current_time
 
-        # Check if we can send a new request
-        if len(self.timestamps) < self.request_limit:
-            self.timestamps.append(current_time)
-            return True
-        return False
+    def allow_request(self) -> bool:
+        return self._take_token() == 0
 
     def throttle(self) -> None:
-        while not self.allow_request():
-            time.sleep(0.5)
+        while True:
+            wait_time = self._take_token()
+            if wait_time == 0:
+                return
+            time.sleep(wait_time)
 
 
 def upload_s3(temp_file,preSignedUrl: str, headers: Dict[str, Any]) -> bool:
@@ -435,8 +636,9 @@ def upload_s3(temp_file,preSignedUrl: str, headers: Dict[str, Any]) -> bool:
 
     try:
         with open(temp_file, 'rb') as file:
-            response: requests.Response = requests.put(preSignedUrl, headers=headersForS3, data=file,
-                                                       verify=verify_cert, proxies=outgoing_proxy, timeout=120)
+            _advise_sequential(file)
+            response: requests.Response = s3_session.put(preSignedUrl, headers=headersForS3, data=file,
+                                                         verify=verify_cert, proxies=outgoing_proxy, timeout=120)
             response.raise_for_status()
             logger.info('File uploaded successfully to S3')
             return True
@@ -449,29 +651,25 @@ def upload_s3(temp_file,preSignedUrl: str, headers: Dict[str, Any]) -> bool:
 
 
 def _createFolder(folder_path: str) -> None:
-    if not os.path.exists(folder_path):  # Check if the directory exists
-        try:
-            os.mkdir(folder_path)  # Create the directory if it doesn't exist
-            print("Created output directory: %s", folder_path)
-        except Exception as e:
-            print("Error creating output folder: %s", folder_path)
-    else:
-        print("Output directory already exists: %s", folder_path)
+    try:
+        os.makedirs(folder_path, exist_ok=True)  # Create the directory if it doesn't exist
+    except Exception as e:
+        print(f"Error creating folder {folder_path}: {e}")
 
 
 def get_s3_upload_url(taskId: str) -> Tuple[Optional[str], Optional[str]]:
-    params: Dict[str, str] = {'fileName': f"{taskId}{uuid.uuid4().hex}"}
+    params: Dict[str, str] = {'fileName': f"{taskId}{_unique_id()}"}
     try:
         rate_limiter.throttle()
-        get_s3_url: requests.Response = requests.get(
-            f"{server_url}/api/http-teleport/upload-url",
+        get_s3_url: requests.Response = ac_session.get(
+            upload_url_url,
             params=params,
             headers=_get_headers(),
             timeout=25, verify=verify_cert, proxies=outgoing_proxy
         )
         get_s3_url.raise_for_status()
 
-        data: Optional[Dict[str, str]] = get_s3_url.json().get('data', None)
+        data: Optional[Dict[str, str]] = _json_loads(get_s3_url.content).get('data', None)
         if data is not None:
             return data.get('putUrl'), data.get('getUrl')
         logger.warning("No data returned when requesting S3 upload URL")
@@ -506,7 +704,13 @@ def setup_logger(index: str, debug_mode: bool) -> logging.Logger:
     else:
         logger.setLevel(logging.INFO)  # Set the log level (DEBUG, INFO, etc.)
 
-    logger.addHandler(handler)
+    # The file is written by a listener thread, so that task threads don't wait on disk I/O while logging
+    log_queue: queue.Queue = queue.Queue(-1)
+    listener: QueueListener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # flush pending records on exit
+
+    logger.addHandler(QueueHandler(log_queue))
     logger.info("Log folder is created %s", log_folder)
     return logger
 